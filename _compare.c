@@ -0,0 +1,129 @@
+/*
+ * Optional C speedup for image_indexer.compare_matrix / compare_vectors.
+ *
+ * Build in place with:  python setup.py build_ext --inplace
+ *
+ * count_mismatches(vectors, query, tolerance) takes N stacked feature vectors
+ * and one query vector (contiguous uint8 buffers of R, G, B pixels) and returns a
+ * list with, for each vector, the number of pixels whose largest channel
+ * difference max(|dR|, |dG|, |dB|) against the query exceeds tolerance.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <stdlib.h>
+
+#if defined(__SSE2__) || defined(_M_X64) || (defined(_M_IX86_FP) && _M_IX86_FP >= 2)
+#include <emmintrin.h>
+#define HAVE_SSE2 1
+#endif
+
+/* Pixels handled per SIMD step: 16 pixels = 48 bytes = three 128-bit registers. */
+#define BLOCK_PIXELS 16
+
+#define MAX3(x, y, z) ((x) > (y) ? ((x) > (z) ? (x) : (z)) : ((y) > (z) ? (y) : (z)))
+
+static Py_ssize_t
+count_row(const uint8_t *a, const uint8_t *b, Py_ssize_t n_pixels, int tolerance)
+{
+    Py_ssize_t p = 0;
+    Py_ssize_t mismatched = 0;
+
+#ifdef HAVE_SSE2
+    uint8_t diff[3 * BLOCK_PIXELS];
+    for (; p + BLOCK_PIXELS <= n_pixels; p += BLOCK_PIXELS) {
+        const uint8_t *pa = a + 3 * p;
+        const uint8_t *pb = b + 3 * p;
+        int k, q;
+        /* |a - b| per byte: saturating subtract both ways and OR the results. */
+        for (k = 0; k < 3; k++) {
+            __m128i va = _mm_loadu_si128((const __m128i *)(pa + 16 * k));
+            __m128i vb = _mm_loadu_si128((const __m128i *)(pb + 16 * k));
+            __m128i d = _mm_or_si128(_mm_subs_epu8(va, vb), _mm_subs_epu8(vb, va));
+            _mm_storeu_si128((__m128i *)(diff + 16 * k), d);
+        }
+        /* Channels are interleaved, so reduce each 3-byte group separately. */
+        for (q = 0; q < BLOCK_PIXELS; q++) {
+            int max_diff = MAX3(diff[3 * q], diff[3 * q + 1], diff[3 * q + 2]);
+            mismatched += max_diff > tolerance;
+        }
+    }
+#endif
+
+    for (; p < n_pixels; p++) {
+        int max_diff = MAX3(abs((int)a[3 * p] - (int)b[3 * p]),
+                            abs((int)a[3 * p + 1] - (int)b[3 * p + 1]),
+                            abs((int)a[3 * p + 2] - (int)b[3 * p + 2]));
+        mismatched += max_diff > tolerance;
+    }
+    return mismatched;
+}
+
+static PyObject *
+count_mismatches(PyObject *self, PyObject *args)
+{
+    Py_buffer vectors, query;
+    int tolerance;
+    Py_ssize_t n_pixels, count, n;
+    Py_ssize_t *results;
+    PyObject *out = NULL;
+
+    if (!PyArg_ParseTuple(args, "y*y*i", &vectors, &query, &tolerance)) {
+        return NULL;
+    }
+
+    if (query.len == 0 || query.len % 3 != 0 || vectors.len % query.len != 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "vectors must be a whole number of query-sized RGB vectors");
+        goto done;
+    }
+    n_pixels = query.len / 3;
+    count = vectors.len / query.len;
+
+    results = PyMem_Malloc((count ? count : 1) * sizeof(Py_ssize_t));
+    if (results == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    for (n = 0; n < count; n++) {
+        results[n] = count_row((const uint8_t *)vectors.buf + n * query.len,
+                               (const uint8_t *)query.buf, n_pixels, tolerance);
+    }
+    Py_END_ALLOW_THREADS
+
+    out = PyList_New(count);
+    if (out != NULL) {
+        for (n = 0; n < count; n++) {
+            PyObject *value = PyLong_FromSsize_t(results[n]);
+            if (value == NULL) {
+                Py_CLEAR(out);
+                break;
+            }
+            PyList_SET_ITEM(out, n, value);
+        }
+    }
+    PyMem_Free(results);
+
+done:
+    PyBuffer_Release(&vectors);
+    PyBuffer_Release(&query);
+    return out;
+}
+
+static PyMethodDef compare_methods[] = {
+    {"count_mismatches", count_mismatches, METH_VARARGS,
+     "count_mismatches(vectors, query, tolerance) -> list of mismatched pixel counts"},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef compare_module = {
+    PyModuleDef_HEAD_INIT, "_compare", NULL, -1, compare_methods
+};
+
+PyMODINIT_FUNC
+PyInit__compare(void)
+{
+    return PyModule_Create(&compare_module);
+}
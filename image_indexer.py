@@ -1,31 +1,79 @@
+import io
 import os
 import json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from PIL import Image
 
+# Numba is optional: when installed, the batched comparison runs as one fused,
+# multi-threaded kernel instead of a chain of NumPy ufuncs.
+try:
+    import numba
+    NUMBA_ENABLED = True
+except ImportError:
+    NUMBA_ENABLED = False
+
+# The C kernel is optional too: build it with `python setup.py build_ext --inplace`.
+try:
+    from _compare import count_mismatches
+    COMPARE_EXT_ENABLED = True
+except ImportError:
+    COMPARE_EXT_ENABLED = False
+
 # --- Configuration ---
-INDEX_FILE = 'image_index.json'
+INDEX_LOG_FILE = 'index_names.jsonl'      # Append-only log of {name, row, mtime, version} additions and removals
+INDEX_VECTORS_FILE = 'index_vectors.npy'  # Preallocated (capacity, pixels, 3) uint8 matrix, memory-mapped
+INDEX_MIN_CAPACITY = 64    # Rows preallocated in the vectors file (doubled on each full rewrite)
+INDEX_COMPACT_RATIO = 0.2  # Rewrite the index on load once this share of log records is stale
+LEGACY_INDEX_FILE = 'image_index.json'    # Old all-JSON index, read once and converted on next save
 IMAGE_DIR = 'images'
 CANONICAL_SIZE = (64, 64)  # All images are resized to 64x64 for fast, consistent comparison
-# Tolerance for comparison (Max Diff for RGB channels)
+NUM_PIXELS = CANONICAL_SIZE[0] * CANONICAL_SIZE[1]  # Rows per feature vector
+# Identifies how feature vectors are produced. Cached or stored vectors made with a
+# different version are rebuilt; change it whenever the decode/resize steps change.
+FEATURE_VERSION = f"{CANONICAL_SIZE[0]}x{CANONICAL_SIZE[1]}-draft-bilinear"
+# Tolerance for comparison (per RGB channel)
 # We will use 15, as confirmed in your previous analysis, but applied to the downscaled image.
+# A pixel matches when its largest channel difference max(|dR|, |dG|, |dB|) is within it.
 RGB_TOLERANCE = 15 
+# Grid of the 256-bit average hash used to pre-filter candidates before the full RGB compare
+HASH_SIZE = (16, 16)
 # --- End Configuration ---
 
 
+def _pil_to_np(img):
+    """
+    Converts a Pillow image to a uint8 NumPy array through its buffer interface.
+    All pixel access goes through here: never iterate img.getdata(), which creates
+    one Python tuple per pixel.
+    """
+    return np.asarray(img, dtype=np.uint8)
+
+def _extract_feature_vector(img):
+    """
+    Normalizes an opened image to a canonical size and extracts its RGB pixels as a
+    uint8 array of shape (pixels, 3).
+    """
+    # Let libjpeg downscale by 1/2, 1/4 or 1/8 while decoding (no-op for other formats)
+    img.draft("RGB", CANONICAL_SIZE)
+    img = img.convert("RGB")
+    # Step 1: Canonical Resize (Neutralizes the size trick)
+    # BILINEAR is plenty for a 64x64 fingerprint and much cheaper than LANCZOS.
+    # Changing the filter changes every vector, so the index must be rebuilt (Mass Update).
+    img_resized = img.resize(CANONICAL_SIZE, Image.Resampling.BILINEAR)
+    
+    # Step 2: Extract Feature Vector (one row of R, G, B values per pixel)
+    # Example: [[R1, G1, B1], [R2, G2, B2], ...]
+    return _pil_to_np(img_resized).reshape(-1, 3)
+
 def get_feature_vector(file_path):
     """
-    Normalizes an image to a canonical size and extracts a flat tuple of all RGB values.
-    This tuple serves as the unique content 'fingerprint' or feature vector.
+    Normalizes an image file to a canonical size and extracts its RGB pixels as a
+    uint8 array of shape (pixels, 3).
+    This array serves as the unique content 'fingerprint' or feature vector.
     """
     try:
-        img = Image.open(file_path).convert("RGB")
-        # Step 1: Canonical Resize (Neutralizes the size trick)
-        img_resized = img.resize(CANONICAL_SIZE, Image.Resampling.LANCZOS)
-        
-        # Step 2: Extract Feature Vector (Flattened list of R, G, B values)
-        # Example: (R1, G1, B1, R2, G2, B2, ...)
-        feature_vector = list(sum(img_resized.getdata(), ())) 
-        return feature_vector
+        return _extract_feature_vector(Image.open(file_path))
     except FileNotFoundError:
         print(f"Error: File not found at {file_path}")
         return None
@@ -33,52 +81,297 @@ def get_feature_vector(file_path):
         print(f"Error processing image {file_path}: {e}")
         return None
 
+def get_feature_vector_from_bytes(data):
+    """Same as get_feature_vector, for an encoded image already held in memory."""
+    try:
+        return _extract_feature_vector(Image.open(io.BytesIO(data)))
+    except Exception as e:
+        print(f"Error processing downloaded image: {e}")
+        return None
+
 def compare_vectors(vector_a, vector_b, tolerance):
     """
-    Compares two feature vectors (lists of RGB integers) using Max Channel Difference.
+    Compares two feature vectors (uint8 arrays of RGB pixels) using Max Channel Difference.
     Returns the match percentage.
     """
-    if len(vector_a) != len(vector_b):
-        return 0.0 # Vectors must be the same length (same canonical size)
+    if vector_a.shape != vector_b.shape:
+        return 0.0 # Vectors must be the same shape (same canonical size)
 
-    total_channels = len(vector_a) # Total number of R, G, B values
-    mismatched_channels = 0
-    
-    # We step through the list 3 elements at a time (R, G, B)
-    for i in range(0, total_channels, 3):
-        diff_r = abs(vector_a[i] - vector_b[i])
-        diff_g = abs(vector_a[i+1] - vector_b[i+1])
-        diff_b = abs(vector_a[i+2] - vector_b[i+2])
-        
-        # Max Diff (L-infinity norm)
-        max_diff = max(diff_r, diff_g, diff_b)
-        
-        if max_diff > tolerance:
-            mismatched_channels += 1
+    if NUMBA_ENABLED and vector_a.shape == (NUM_PIXELS, 3):
+        return 100.0 - 100.0 * _count_mismatches_jit(vector_a, vector_b, tolerance) / NUM_PIXELS
+    if COMPARE_EXT_ENABLED:
+        mismatched = count_mismatches(np.ascontiguousarray(vector_a), np.ascontiguousarray(vector_b), tolerance)[0]
+        return 100.0 - 100.0 * mismatched / len(vector_a)
 
-    # Mismatched_channels is the count of PIXELS that mismatched (since we incremented by 3)
-    total_pixels = total_channels / 3
-    
-    match_percentage = 100 - (mismatched_channels / total_pixels) * 100
-    return match_percentage
+    # Subtract straight into int16 so the difference can go negative, then take the
+    # Max Diff (L-infinity norm) across the R, G, B channels of each pixel.
+    max_diff = np.abs(np.subtract(vector_a, vector_b, dtype=np.int16)).max(axis=1)
 
-def load_index():
-    """Loads the index file if it exists, otherwise returns an empty dictionary."""
-    if os.path.exists(INDEX_FILE):
-        with open(INDEX_FILE, 'r') as f:
+    # Percentage of PIXELS whose max channel difference is within tolerance
+    match_percentage = 100.0 * (max_diff <= tolerance).mean()
+    return float(match_percentage)
+
+if NUMBA_ENABLED:
+    @numba.njit(fastmath=True, cache=True)
+    def _count_mismatches_jit(vector_a, vector_b, tolerance):
+        """
+        Counts the pixels of two canonical vectors whose max channel difference
+        exceeds tolerance.
+        NUM_PIXELS is a module global, which Numba freezes as a compile-time constant,
+        so the loop has a fixed trip count that LLVM can unroll and vectorize.
+        """
+        mismatched = 0
+        for p in range(NUM_PIXELS):
+            max_diff = max(abs(np.int32(vector_a[p, 0]) - np.int32(vector_b[p, 0])),
+                           abs(np.int32(vector_a[p, 1]) - np.int32(vector_b[p, 1])),
+                           abs(np.int32(vector_a[p, 2]) - np.int32(vector_b[p, 2])))
+            if max_diff > tolerance:
+                mismatched += 1
+        return mismatched
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _compare_matrix_jit(matrix, vector, tolerance):
+        """Fused max-diff + tolerance + count kernel, one index entry per thread."""
+        count = matrix.shape[0]
+        out = np.empty(count, dtype=np.float64)
+        for n in numba.prange(count):
+            out[n] = 100.0 - 100.0 * _count_mismatches_jit(matrix[n], vector, tolerance) / NUM_PIXELS
+        return out
+
+def compare_matrix(matrix, vector, tolerance):
+    """
+    Compares one feature vector against every row of a stacked (N, pixels, 3) matrix
+    in a single broadcasted pass. Returns an array of N match percentages.
+    """
+    # The compiled kernel is specialized for canonical-size vectors only
+    if NUMBA_ENABLED and len(matrix) and matrix.shape[1:] == vector.shape == (NUM_PIXELS, 3):
+        return _compare_matrix_jit(matrix, vector, tolerance)
+    if COMPARE_EXT_ENABLED and len(matrix):
+        mismatched = np.asarray(count_mismatches(np.ascontiguousarray(matrix), np.ascontiguousarray(vector), tolerance))
+        return 100.0 - 100.0 * mismatched / matrix.shape[1]
+
+    max_diff = np.abs(np.subtract(matrix, vector, dtype=np.int16)).max(axis=2)
+    return 100.0 * (max_diff <= tolerance).mean(axis=1)
+
+def compute_hashes(matrix):
+    """
+    Computes a 256-bit average hash (aHash) for every row of a stacked (N, pixels, 3)
+    matrix. Each image is converted to grayscale, averaged down to HASH_SIZE blocks,
+    and each bit is set when its block is brighter than the image mean.
+    Returns an (N, 4) uint64 array.
+    """
+    count = matrix.shape[0]
+    width, height = CANONICAL_SIZE
+    hash_h, hash_w = HASH_SIZE
+
+    # ITU-R 601 luma, the same weights Pillow uses for convert('L')
+    gray = matrix.astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    blocks = gray.reshape(count, hash_h, height // hash_h, hash_w, width // hash_w).mean(axis=(2, 4))
+    blocks = blocks.reshape(count, hash_h * hash_w)
+
+    bits = blocks > blocks.mean(axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(np.uint64)
+
+def hamming_distances(hashes, query_hash):
+    """Returns the number of differing bits between each row of hashes and query_hash."""
+    xor = np.bitwise_xor(hashes, query_hash)
+    if hasattr(np, 'bitwise_count'):
+        # NumPy >= 2.0 lowers this to popcnt
+        return np.bitwise_count(xor).sum(axis=1)
+    return np.unpackbits(xor.view(np.uint8), axis=1).sum(axis=1)
+
+def mean_prefilter_tolerance(tolerance, min_confidence):
+    """
+    Returns the largest difference in mean channel value two vectors can have while
+    still reaching min_confidence percent. The mean difference is at most the average
+    absolute channel difference: every channel of a matching pixel differs by at most
+    tolerance, and of a mismatching one by at most 255. So entries further apart
+    than this bound can be skipped without ever losing a match at or above
+    min_confidence.
+    """
+    matched = min_confidence / 100.0
+    return matched * tolerance + (1.0 - matched) * 255
+
+def stack_vectors(vectors):
+    """Stacks feature vectors into one contiguous (N, pixels, 3) uint8 matrix."""
+    if vectors:
+        return np.stack(vectors)
+    return np.empty((0, NUM_PIXELS, 3), dtype=np.uint8)
+
+def build_search_index(index_data):
+    """
+    Stacks all indexed vectors into one contiguous (N, pixels, 3) uint8 matrix so a
+    query can be scored against the whole index at once, along with their hashes.
+    """
+    names = list(index_data.keys())
+    matrix = stack_vectors([entry['vector'] for entry in index_data.values()])
+    return {
+        "names": names,
+        "matrix": matrix,
+        "hashes": compute_hashes(matrix),
+        "means": matrix.mean(axis=(1, 2)),
+    }
+
+def load_legacy_index():
+    """Loads an old JSON index (name -> flat list of integers) into unsaved index entries."""
+    with open(LEGACY_INDEX_FILE, 'r') as f:
+        try:
+            return {
+                name: {'vector': np.asarray(vector, dtype=np.uint8).reshape(-1, 3), 'row': None, 'mtime': None}
+                for name, vector in json.load(f).items()
+            }
+        except json.JSONDecodeError:
+            print("Warning: Index file corrupted. Starting fresh.")
+            return {}
+
+def read_index_log():
+    """
+    Replays the index log in order, so later records override earlier ones.
+    Returns ({name: latest record}, number of records read).
+    Raises ValueError if a record is not a valid addition or removal.
+    """
+    records = {}
+    record_count = 0
+    with open(INDEX_LOG_FILE, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
             try:
-                # The stored vectors are lists of integers, which is JSON-safe.
-                return json.load(f)
+                record = json.loads(line)
             except json.JSONDecodeError:
-                print("Warning: Index file corrupted. Starting fresh.")
-                return {}
+                # Most likely a write interrupted mid-line; the row it pointed to is unused
+                print("Warning: Skipping unreadable record in the index log.")
+                continue
+            if not isinstance(record, dict) or not isinstance(record.get('name'), str):
+                raise ValueError(f"invalid index record {line.strip()!r}")
+            record_count += 1
+            if record.get('removed'):
+                records.pop(record['name'], None)
+            elif isinstance(record.get('row'), int) and record['row'] >= 0:
+                records[record['name']] = record
+            else:
+                raise ValueError(f"invalid index record {line.strip()!r}")
+    return records, record_count
+
+def discard_index_files(reason):
+    """
+    Moves unusable index files aside (as *.bad), so nothing is ever appended to them
+    and the next write is a full save_index.
+    """
+    print(f"Warning: {reason} Starting fresh; the old index files were renamed to *.bad.")
+    for path in (INDEX_LOG_FILE, INDEX_VECTORS_FILE):
+        if os.path.exists(path):
+            try:
+                os.replace(path, path + '.bad')
+            except OSError as e:
+                print(f"Warning: Could not move '{path}' aside ({e}).")
+
+def load_index():
+    """
+    Loads the index files if they exist, otherwise returns an empty dictionary.
+    Each entry is {'vector': ..., 'row': ..., 'mtime': ...}, where the vector is a
+    zero-copy view of its row in the memory-mapped matrix and mtime is the source
+    file's modification time when it was indexed (None if unknown, or if the vector
+    was made with a different FEATURE_VERSION, so Mass Update rebuilds it). The index is
+    compacted if too many log records are stale; unusable index files are moved aside.
+    """
+    if os.path.exists(INDEX_LOG_FILE) and os.path.exists(INDEX_VECTORS_FILE):
+        # Read the log before mapping the vectors, so nothing is mapped if either fails
+        try:
+            records, record_count = read_index_log()
+            vectors = np.load(INDEX_VECTORS_FILE, mmap_mode='r')
+        except (ValueError, EOFError, OSError) as e:
+            discard_index_files(f"Index file corrupted ({e}).")
+            return {}
+
+        if (vectors.dtype != np.uint8 or vectors.shape[1:] != (NUM_PIXELS, 3)
+                or any(record['row'] >= len(vectors) for record in records.values())):
+            del vectors
+            discard_index_files("Index names and vectors are out of sync.")
+            return {}
+        index_data = {
+            name: {
+                'vector': vectors[record['row']],
+                'row': record['row'],
+                'mtime': record.get('mtime') if record.get('version') == FEATURE_VERSION else None,
+            }
+            for name, record in records.items()
+        }
+        # Only the entries may keep the mapping alive: save_index releases them before rewriting the file
+        del vectors
+
+        if record_count - len(index_data) > INDEX_COMPACT_RATIO * record_count:
+            print("Compacting index...")
+            save_index(index_data)
+        return index_data
+    if os.path.exists(LEGACY_INDEX_FILE):
+        print(f"Note: Converting '{LEGACY_INDEX_FILE}' to the new index format on the next save.")
+        return load_legacy_index()
     return {}
 
 def save_index(index_data):
-    """Saves the current index dictionary to the file."""
-    with open(INDEX_FILE, 'w') as f:
-        json.dump(index_data, f, indent=4)
-    print(f"\nSuccessfully saved {len(index_data)} entries to {INDEX_FILE}.")
+    """
+    Rewrites the whole index: packs all vectors into the first rows of a freshly
+    preallocated vectors file and writes one log record per entry.
+    """
+    names = list(index_data.keys())
+    matrix = stack_vectors([entry['vector'] for entry in index_data.values()])
+    # Point the entries at the in-memory copy first, so no view of the old
+    # memory-mapped file is still alive while it is being overwritten.
+    for row, name in enumerate(names):
+        index_data[name] = {'vector': matrix[row], 'row': row, 'mtime': index_data[name]['mtime']}
+
+    capacity = max(INDEX_MIN_CAPACITY, 2 * len(names))
+    vectors = np.lib.format.open_memmap(INDEX_VECTORS_FILE, mode='w+', dtype=np.uint8,
+                                        shape=(capacity,) + matrix.shape[1:])
+    vectors[:len(matrix)] = matrix
+    vectors.flush()
+    del vectors
+
+    with open(INDEX_LOG_FILE, 'w') as f:
+        for row, name in enumerate(names):
+            f.write(json.dumps({'name': name, 'row': row, 'mtime': index_data[name]['mtime'],
+                                'version': FEATURE_VERSION}) + '\n')
+    print(f"\nSuccessfully saved {len(index_data)} entries to {INDEX_LOG_FILE} and {INDEX_VECTORS_FILE}.")
+
+def add_index_entry(index_data, name, vector, mtime=None):
+    """
+    Adds (or replaces) a single entry by writing its vector into the next free row
+    of the vectors file and appending one log record, instead of rewriting the index.
+    Falls back to a full save when there is no saved index yet or no free row left.
+    """
+    next_row = max((entry['row'] for entry in index_data.values() if entry['row'] is not None), default=-1) + 1
+
+    if os.path.exists(INDEX_LOG_FILE) and os.path.exists(INDEX_VECTORS_FILE):
+        try:
+            vectors = np.lib.format.open_memmap(INDEX_VECTORS_FILE, mode='r+')
+        except (ValueError, EOFError, OSError) as e:
+            print(f"Warning: Could not open '{INDEX_VECTORS_FILE}' for writing ({e}). Rewriting the index.")
+            vectors = None
+        has_room = vectors is not None and next_row < len(vectors)
+        if has_room:
+            vectors[next_row] = vector
+            vectors.flush()
+        del vectors
+
+        if has_room:
+            with open(INDEX_LOG_FILE, 'a') as f:
+                f.write(json.dumps({'name': name, 'row': next_row, 'mtime': mtime,
+                                    'version': FEATURE_VERSION}) + '\n')
+            index_data[name] = {'vector': vector, 'row': next_row, 'mtime': mtime}
+            return
+
+    index_data[name] = {'vector': vector, 'row': None, 'mtime': mtime}
+    save_index(index_data)
+
+def remove_index_entry(index_data, name):
+    """Removes a single entry by appending a tombstone record to the log."""
+    del index_data[name]
+    if os.path.exists(INDEX_LOG_FILE) and os.path.exists(INDEX_VECTORS_FILE):
+        with open(INDEX_LOG_FILE, 'a') as f:
+            f.write(json.dumps({'name': name, 'removed': True}) + '\n')
+    else:
+        save_index(index_data)
 
 def index_all_images(index_data):
     """Scans the image directory and updates/adds all files to the index."""
@@ -88,22 +381,36 @@ def index_all_images(index_data):
         
     print(f"\nStarting indexing of files in '{IMAGE_DIR}'...")
     new_count = 0
+    display_names = []
+    file_paths = []
+    mtimes = []
     
-    for filename in os.listdir(IMAGE_DIR):
-        if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
-            file_path = os.path.join(IMAGE_DIR, filename)
-            # Use filename without extension as the display name (key)
-            display_name = os.path.splitext(filename)[0] 
-            
-            # Skip if already indexed and file hasn't changed (simplified)
-            if display_name in index_data:
-                # For simplicity, we re-index to handle file updates. 
-                # A more complex system would check file modification time.
-                pass 
+    # scandir yields the full path and caches stat info on each DirEntry
+    with os.scandir(IMAGE_DIR) as dir_entries:
+        for dir_entry in dir_entries:
+            if dir_entry.is_file() and dir_entry.name.lower().endswith(('.png', '.jpg', '.jpeg')):
+                # Use filename without extension as the display name (key)
+                display_name = os.path.splitext(dir_entry.name)[0] 
                 
-            vector = get_feature_vector(file_path)
-            if vector:
-                index_data[display_name] = vector
+                # Skip if already indexed and file hasn't changed since
+                mtime = dir_entry.stat().st_mtime
+                entry = index_data.get(display_name)
+                if entry is not None and entry['mtime'] == mtime:
+                    continue
+                    
+                display_names.append(display_name)
+                file_paths.append(dir_entry.path)
+                mtimes.append(mtime)
+
+    if not file_paths:
+        return new_count
+
+    # Decoding and resizing is CPU-bound, so spread the files over all cores
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        vectors = executor.map(get_feature_vector, file_paths, chunksize=4)
+        for display_name, mtime, vector in zip(display_names, mtimes, vectors):
+            if vector is not None:
+                index_data[display_name] = {'vector': vector, 'row': None, 'mtime': mtime}
                 new_count += 1
                 
     return new_count
@@ -113,7 +420,7 @@ if __name__ == '__main__':
     print("Testing Feature Extraction Utility...")
     # This assumes you have 'maybe.png' in the current directory for testing
     # test_vector = get_feature_vector('maybe.png') 
-    # if test_vector:
-    #     print(f"Test vector length: {len(test_vector)} (should be 12288 for 64x64)")
-    #     print(f"First 10 values: {test_vector[:10]}")
+    # if test_vector is not None:
+    #     print(f"Test vector shape: {test_vector.shape} (should be (4096, 3) for 64x64)")
+    #     print(f"First 10 values: {test_vector.reshape(-1)[:10]}")
     print("This file contains utility functions. Run 'app.py' to manage the index.")
@@ -1,8 +1,11 @@
 import os
+import hashlib
 import tempfile
+from collections import OrderedDict
 import urllib.request
 import urllib.error
-from image_indexer import get_feature_vector, compare_vectors, load_index, save_index, index_all_images, RGB_TOLERANCE
+import numpy as np
+from image_indexer import get_feature_vector, get_feature_vector_from_bytes, compare_matrix, compute_hashes, hamming_distances, mean_prefilter_tolerance, build_search_index, load_index, save_index, add_index_entry, remove_index_entry, index_all_images, RGB_TOLERANCE, NUM_PIXELS, FEATURE_VERSION
 
 # Try to import pyperclip for clipboard operations. User must install this.
 try:
@@ -14,6 +17,13 @@ except ImportError:
 
 # --- Configuration ---
 STRONG_MATCH_THRESHOLD = 60.0 
+# Only the entries with the closest hashes get the full RGB comparison
+HASH_CANDIDATES = 32
+URL_TIMEOUT = 15  # Seconds to wait for an image download
+# Feature vectors of analyzed URLs are cached in memory and on disk, keyed by URL
+URL_CACHE_SIZE = 128        # Entries kept in memory
+URL_DISK_CACHE_SIZE = 1024  # Files kept in URL_CACHE_DIR (about 12 KB each)
+URL_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'image_comparator_cache')
 # --- End Configuration ---
 
 def copy_to_clipboard(text):
@@ -25,30 +35,44 @@ def copy_to_clipboard(text):
         except Exception as e:
             print(f"Error copying to clipboard: {e}")
 
-def run_comparison_logic(input_path, index_data):
+def run_comparison_logic(input_path, search_index):
     """Core logic to compare a given image file against the index."""
-    
-    new_vector = get_feature_vector(input_path)
-    if not new_vector:
+    run_vector_comparison(get_feature_vector(input_path), search_index)
+
+def run_vector_comparison(new_vector, search_index):
+    """Compares an already-extracted feature vector against the index."""
+    if new_vector is None:
         print("Comparison failed: Could not process the input image.")
         return
 
-    print(f"\n--- Comparing Input Image against {len(index_data)} Indexed Entries (Tolerance: {RGB_TOLERANCE}) ---")
+    names = search_index["names"]
+    print(f"\n--- Comparing Input Image against {len(names)} Indexed Entries (Tolerance: {RGB_TOLERANCE}) ---")
     
-    # Store results for sorting
-    match_results = []
+    # Pre-filter 1: drop entries whose mean color is too far off to ever reach a strong match
+    mean_tolerance = mean_prefilter_tolerance(RGB_TOLERANCE, STRONG_MATCH_THRESHOLD)
+    candidates = np.flatnonzero(np.abs(search_index["means"] - new_vector.mean()) <= mean_tolerance)
+    if len(candidates) == 0:
+        # Nothing can reach a strong match; still rank the closest entries for the report below
+        candidates = np.arange(len(names))
 
-    for name, indexed_vector in index_data.items():
-        confidence = compare_vectors(new_vector, indexed_vector, RGB_TOLERANCE)
-        
-        match_results.append({"name": name, "confidence": confidence})
-        
-        # Print very high-confidence matches immediately
-        if confidence > 99.0:
-            print(f"  --> NEAR PERFECT MATCH FOUND: '{name}' with {confidence:.2f}% confidence!")
+    # Pre-filter 2: keep only the remaining entries whose hashes are closest to the query's
+    if len(candidates) > HASH_CANDIDATES:
+        query_hash = compute_hashes(new_vector[np.newaxis])[0]
+        distances = hamming_distances(search_index["hashes"][candidates], query_hash)
+        candidates = candidates[np.argpartition(distances, HASH_CANDIDATES - 1)[:HASH_CANDIDATES]]
+
+    # Score the remaining candidates in one batched pass
+    confidences = compare_matrix(search_index["matrix"][candidates], new_vector, RGB_TOLERANCE)
+
+    # Print very high-confidence matches immediately
+    for i in np.flatnonzero(confidences > 99.0):
+        print(f"  --> NEAR PERFECT MATCH FOUND: '{names[candidates[i]]}' with {confidences[i]:.2f}% confidence!")
 
-    # Sort results to find the top matches
-    match_results.sort(key=lambda x: x['confidence'], reverse=True)
+    # Find the top 5 matches: partition them out in O(N), then sort only those
+    k = min(5, len(confidences))
+    top = np.argpartition(-confidences, k - 1)[:k] if k else np.arange(0)
+    top = top[np.argsort(-confidences[top], kind="stable")]
+    match_results = [{"name": names[candidates[i]], "confidence": float(confidences[i])} for i in top]
     
     # Extract the best match
     best_match = match_results[0] if match_results else {"name": "None", "confidence": 0.0}
@@ -56,7 +80,7 @@ def run_comparison_logic(input_path, index_data):
     print("\n--- TOP MATCHES ---")
     
     # Print the top 5 results
-    for i, result in enumerate(match_results[:5]):
+    for i, result in enumerate(match_results):
         print(f"  #{i+1}: '{result['name']}' ({result['confidence']:.2f}%)")
 
     print("\n--- FINAL CONCLUSION ---")
@@ -68,9 +92,9 @@ def run_comparison_logic(input_path, index_data):
         print(f"No strong match found. Best result: '{best_match['name']}' ({best_match['confidence']:.2f}%).")
 
 
-def compare_local_file(index_data):
+def compare_local_file(search_index):
     """Handles comparison for a local file path (Option 1)."""
-    if not index_data:
+    if not search_index["names"]:
         print("\nIndex is empty. Please run 'Mass Update' first.")
         return
 
@@ -80,16 +104,16 @@ def compare_local_file(index_data):
         print("Error: File not found at that path.")
         return
         
-    run_comparison_logic(input_path, index_data)
+    run_comparison_logic(input_path, search_index)
 
 
-def analyze_image_url(index_data, pre_pasted_url=None):
+def analyze_image_url(search_index, pre_pasted_url=None):
     """
     Handles comparison for a direct image URL.
     If pre_pasted_url is provided, it uses that directly.
     Otherwise, it falls back to clipboard or manual input.
     """
-    if not index_data:
+    if not search_index["names"]:
         print("\nIndex is empty. Please run 'Mass Update' first.")
         return
 
@@ -111,42 +135,98 @@ def analyze_image_url(index_data, pre_pasted_url=None):
     else:
         print(f"\nAnalyzing URL: {image_url}")
     
-    # Use a temporary file to download the image
-    temp_file_path = os.path.join(tempfile.gettempdir(), 'temp_image_for_analysis.png')
-
-    print(f"Attempting to download image from URL...")
     try:
-        # Request the image using built-in urllib.request
-        opener = urllib.request.build_opener()
-        opener.addheaders = [('User-agent', 'Mozilla/5.0')]
-        urllib.request.install_opener(opener)
-        
-        # Download and save the image to the temporary file
-        urllib.request.urlretrieve(image_url, temp_file_path)
-        print("Download complete. Analyzing...")
+        new_vector = fetch_url_vector(image_url)
+        print("Analyzing...")
         
         # Run the core comparison logic
-        run_comparison_logic(temp_file_path, index_data)
+        run_vector_comparison(new_vector, search_index)
 
     except urllib.error.URLError as e:
         print(f"Error downloading image: Invalid URL or network issue. ({e})")
     except Exception as e:
         print(f"An unexpected error occurred during download/analysis: {e}")
-    finally:
-        # Clean up the temporary file
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+
+
+# In-memory LRU of URL -> feature vector. Failed fetches are never stored, so a retry downloads again.
+url_vector_cache = OrderedDict()
+
+def fetch_url_vector(image_url):
+    """
+    Returns the feature vector of the image at image_url, or None if it could not be processed.
+    Repeated URLs are served from memory (LRU) or from the on-disk cache in
+    URL_CACHE_DIR, so the download and decode only happen once per URL.
+    """
+    vector = url_vector_cache.get(image_url)
+    if vector is None:
+        # The key includes FEATURE_VERSION so vectors made by an older pipeline are never reused
+        cache_key = hashlib.sha1(f"{FEATURE_VERSION}\n{image_url}".encode('utf-8')).hexdigest()
+        cache_path = os.path.join(URL_CACHE_DIR, cache_key + '.npy')
+        vector = read_cached_vector(cache_path)
+
+        if vector is None:
+            print(f"Attempting to download image from URL...")
+            # Request the image using built-in urllib.request and decode it straight from memory
+            request = urllib.request.Request(image_url, headers={'User-agent': 'Mozilla/5.0'})
+            with urllib.request.urlopen(request, timeout=URL_TIMEOUT) as response:
+                data = response.read()
+            print("Download complete.")
+            vector = get_feature_vector_from_bytes(data)
+            if vector is None:
+                return None
+            write_cached_vector(cache_path, vector)
+
+        url_vector_cache[image_url] = vector
+        if len(url_vector_cache) > URL_CACHE_SIZE:
+            url_vector_cache.popitem(last=False)
+
+    url_vector_cache.move_to_end(image_url)
+    return vector
+
+def read_cached_vector(cache_path):
+    """Loads a vector from the disk cache. Unreadable entries are deleted and treated as a miss."""
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        vector = np.load(cache_path)
+        if vector.shape == (NUM_PIXELS, 3) and vector.dtype == np.uint8:
+            os.utime(cache_path) # Mark as recently used for pruning
+            return vector
+    except (ValueError, EOFError, OSError):
+        pass
+    try:
+        os.remove(cache_path)
+    except OSError:
+        pass
+    return None
+
+def write_cached_vector(cache_path, vector):
+    """Stores a vector in the disk cache, then drops the least recently used files over URL_DISK_CACHE_SIZE."""
+    try:
+        os.makedirs(URL_CACHE_DIR, exist_ok=True)
+        np.save(cache_path, vector)
+        with os.scandir(URL_CACHE_DIR) as dir_entries:
+            cached = [entry for entry in dir_entries if entry.is_file() and entry.name.endswith('.npy')]
+        if len(cached) > URL_DISK_CACHE_SIZE:
+            cached.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in cached[:len(cached) - URL_DISK_CACHE_SIZE]:
+                os.remove(entry.path)
+    except OSError as e:
+        # The cache is only an optimization; never fail the analysis over it
+        print(f"Warning: Could not update the URL cache ({e}).")
 
 
 def manage_index():
-    """Provides the menu for managing the JSON index file."""
+    """Provides the menu for managing the image index."""
     index_data = load_index()
+    # Stacked matrix of all vectors, rebuilt whenever the index changes
+    search_index = build_search_index(index_data)
     
     while True:
         print("\n--- Image Index Manager ---")
         print(f"Current Index Size: {len(index_data)} entries")
         print("1. Cross-Reference Local File")
-        print("2. Mass Update (Re-index all files in 'images/')")
+        print("2. Mass Update (Index new and changed files in 'images/')")
         print("3. Add Data (Index a specific single file)")
         print("4. Remove Data (Remove a specific entry)")
         
@@ -164,17 +244,19 @@ def manage_index():
 
         # Check if the user pasted a URL directly
         if choice.strip().lower().startswith("http"):
-             analyze_image_url(index_data, pre_pasted_url=choice.strip())
+             analyze_image_url(search_index, pre_pasted_url=choice.strip())
              continue
 
         if choice == '1':
-            compare_local_file(index_data)
+            compare_local_file(search_index)
         
         elif choice == '2':
             # Mass Update
             count = index_all_images(index_data)
             print(f"Indexed/Updated {count} files.")
-            save_index(index_data)
+            if count:
+                save_index(index_data)
+                search_index = build_search_index(index_data)
         
         elif choice == '3':
             # Add Data
@@ -182,10 +264,10 @@ def manage_index():
             display_name = input("Enter a display name for this entry (e.g., 'My_New_Image'): ")
             
             vector = get_feature_vector(file_path)
-            if vector:
-                index_data[display_name] = vector
+            if vector is not None:
+                add_index_entry(index_data, display_name, vector)
                 print(f"Successfully added '{display_name}'.")
-                save_index(index_data)
+                search_index = build_search_index(index_data)
         
         elif choice == '4':
             # Remove Data
@@ -195,14 +277,14 @@ def manage_index():
                 
             name_to_remove = input("Enter the display name of the entry to remove: ")
             if name_to_remove in index_data:
-                del index_data[name_to_remove]
+                remove_index_entry(index_data, name_to_remove)
                 print(f"Successfully removed '{name_to_remove}'.")
-                save_index(index_data)
+                search_index = build_search_index(index_data)
             else:
                 print(f"Error: Entry '{name_to_remove}' not found in the index.")
         
         elif choice == '5':
-            analyze_image_url(index_data)
+            analyze_image_url(search_index)
 
         elif choice == '6':
             print("Exiting Image Comparator. Goodbye!")
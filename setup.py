@@ -0,0 +1,11 @@
+# Builds the optional C comparison kernel used by image_indexer.py.
+# Usage: python setup.py build_ext --inplace
+import sys
+from setuptools import setup, Extension
+
+extra_compile_args = [] if sys.platform == 'win32' else ['-O3']
+
+setup(
+    name='image-comparator-compare',
+    ext_modules=[Extension('_compare', ['_compare.c'], extra_compile_args=extra_compile_args)],
+)